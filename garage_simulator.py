@@ -1,11 +1,57 @@
 import pygame
 import json
+import collections
+import concurrent.futures
+import hmac
+import logging
 import threading
 import time
 import sys
 import os
+import re
+import socket
 import garage_config
 
+log = logging.getLogger("garage_sim")
+
+# Prefer orjson for payload parsing, fallback to the standard library
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Prefer msgspec for typed decoding of state messages, fallback to json_loads
+try:
+    import msgspec
+
+    class GarageMsg(msgspec.Struct, frozen=True):
+        """Fields of a garage state message read by the simulator"""
+        state: str | None = None
+        token: str | None = None
+
+    USE_MSGSPEC = True
+except ImportError:
+    USE_MSGSPEC = False
+
+# Prefer xxhash for duplicate payload detection, fallback to the builtin hash
+try:
+    import xxhash
+    hash_payload = xxhash.xxh64_intdigest
+except ImportError:
+    hash_payload = hash
+
+# Optional local channel that receives state messages directly from the controller
+try:
+    import zmq
+    USE_ZMQ = True
+except ImportError:
+    USE_ZMQ = False
+
+# Local state endpoint shared with the controller, ipc sockets are not available on Windows
+LOCAL_STATE_ENDPOINT = getattr(garage_config, 'LOCAL_STATE_ENDPOINT',
+                               "tcp://127.0.0.1:5556" if sys.platform == "win32" else "ipc:///tmp/garage.sock")
+
 # Try to use AWS IoT SDK first, fallback to paho-mqtt
 try:
     from awsiot import mqtt_connection_builder
@@ -20,21 +66,65 @@ except ImportError:
 
 
 class GarageSimulator:
+    # Targeted extractors for the two fields the simulator reads from state messages
+    _STATE_RE = re.compile(rb'"state"\s*:\s*"([^"]*)"')
+    _TOKEN_RE = re.compile(rb'"token"\s*:\s*"([^"]*)"')
+
     def __init__(self):
         pygame.init()
+
+        # Only queue the events run() handles, SDL drops everything else
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.VIDEOEXPOSE])
         self.screen = pygame.display.set_mode((600, 600))
         pygame.display.set_caption("Garage Door Simulator")
         self.clock = pygame.time.Clock()
+
+        # Fonts and rendered text are cached, the status strings never change
+        self._font_big = pygame.font.Font(None, 48)
+        self._font_med = pygame.font.Font(None, 28)
+        self._font_small = pygame.font.Font(None, 24)
+        self._text_cache = {}
+        for text, color in (("GARAGE: OPEN", (50, 200, 50)), ("GARAGE: CLOSED", (220, 50, 50))):
+            self._render(self._font_big, text, color)
+        for text, color in (("MQTT: CONNECTED", (50, 200, 50)), ("MQTT: OFFLINE", (220, 50, 50))):
+            self._render(self._font_med, text, color)
+
+        self._bg = self.render_background()
         self.door_height = 0
         self.door_open = False
         self.connected = False
         self.running = True
-        self.last_update_time = time.time()
         self.connection_attempts = 0
         self.max_connection_attempts = 5
+        self._backoff = 2  # Seconds before the next connection attempt
+        self._backoff_max = 128
+        # Hashes of recently processed payloads, the same state can arrive over MQTT and locally
+        self._recent_hashes = collections.deque(maxlen=8)
+        self._recent_set = set()
+        self._recent_lock = threading.Lock()
+        self._token_bytes = garage_config.SECRET_TOKEN.encode()
+        self._decoder = msgspec.json.Decoder(GarageMsg) if USE_MSGSPEC else None
+        self._dirty = True  # Redraw needed on the next frame
+        self._pending = collections.deque(maxlen=8)  # Door states from MQTT, applied by run()
+
+        # Screen regions that change between frames: status panel, garage, position text
+        self._dirty_rects = [
+            pygame.Rect(0, 0, 600, 82),
+            pygame.Rect(150, 100, 300, 450),
+            pygame.Rect(0, 550, 600, 50)
+        ]
+
+        # Single long-lived worker that (re)connects when signalled
+        self._reconnect_evt = threading.Event()
+
+        # Local state messages arrive alongside MQTT, duplicates are dropped by hash
+        if USE_ZMQ:
+            threading.Thread(target=self.local_state_listener, daemon=True).start()
 
         # Setup MQTT client based on available SDK
         if USE_AWS_SDK:
+            threading.Thread(target=self.reconnect_loop, daemon=True).start()
             self.setup_aws_iot_connection()
         else:
             self.setup_paho_mqtt_connection()
@@ -61,18 +151,18 @@ class GarageSimulator:
                 ca_filepath='root-CA.crt',
                 client_id='garage_simulator',
                 clean_session=False,
-                keep_alive_secs=30
+                keep_alive_secs=30,
+                reconnect_min_timeout_secs=self._backoff,
+                reconnect_max_timeout_secs=self._backoff_max,
+                on_connection_interrupted=self.on_connection_interrupted,
+                on_connection_resumed=self.on_connection_resumed
             )
 
-            # Set up callbacks with timeout
-            connect_future = self.mqtt_connection.connect()
-            connect_future.add_done_callback(self.on_aws_connection_result)
+            # Hand the connect off to the reconnect worker
+            self._reconnect_evt.set()
 
             print("AWS IoT connection initiated...")
 
-            # Add connection timeout
-            threading.Timer(10.0, self.check_connection_timeout).start()
-
         except Exception as e:
             print(f"AWS IoT SDK connection error: {e}")
             print("Falling back to paho-mqtt...")
@@ -109,6 +199,9 @@ class GarageSimulator:
             self.client.on_message = self.on_message
             self.client.on_disconnect = self.on_disconnect
 
+            # Paho's network thread retries failed and dropped connections with exponential backoff
+            self.client.reconnect_delay_set(min_delay=self._backoff, max_delay=self._backoff_max)
+
             # Try multiple SSL configurations with correct certificate files
             ssl_configs = [
                 # Config 1: Basic SSL with insecure mode
@@ -141,9 +234,9 @@ class GarageSimulator:
                     print(f"Trying {ssl_config['name']}...")
                     ssl_config['config']()
 
-                    # Connect to IoT endpoint
+                    # Connect to IoT endpoint, the loop thread keeps retrying until it succeeds
                     print(f"Connecting to AWS IoT endpoint: {garage_config.IOT_ENDPOINT}")
-                    self.client.connect(garage_config.IOT_ENDPOINT, 8883, 60)
+                    self.client.connect_async(garage_config.IOT_ENDPOINT, 8883, 60)
 
                     # Start MQTT loop in separate thread
                     self.client.loop_start()
@@ -160,44 +253,118 @@ class GarageSimulator:
             print(f"MQTT connection error: {e}")
             print("Running in offline mode - simulator will not receive real-time updates")
 
-    def on_aws_connection_result(self, connect_future):
-        """Callback for AWS IoT SDK connection result"""
-        try:
-            connect_future.result()
-            print("AWS IoT connection successful!")
-            self.connected = True
-
-            # Subscribe to garage state topic
-            subscribe_future, packet_id = self.mqtt_connection.subscribe(
-                topic="garage/state",
-                qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_aws_message_received
-            )
-            print("Subscribed to garage/state topic")
+    def reconnect_loop(self):
+        """Wait for a reconnect request and connect with backoff, reusing one thread"""
+        first = True
+        while self.running:
+            self._reconnect_evt.wait()
+            self._reconnect_evt.clear()
+            if not self.running:
+                return
 
-        except Exception as e:
-            print(f"AWS IoT connection failed: {e}")
-            print("Falling back to paho-mqtt...")
-            self.connected = False
-            self.setup_paho_mqtt_connection()
+            # Stop the SDK's own reconnect attempts before connecting again
+            if not first:
+                try:
+                    self.mqtt_connection.disconnect().result(timeout=10)
+                except Exception as e:
+                    log.debug("Disconnect before reconnect: %s", e)
+            first = False
+            self.connect_aws_with_backoff()
+
+    def on_connection_interrupted(self, connection, error, **kwargs):
+        """AWS IoT SDK lost the connection, it reconnects on its own with backoff"""
+        print(f"AWS IoT connection interrupted: {error}")
+        self.connected = False
+        self._dirty = True
+
+    def on_connection_resumed(self, connection, return_code, session_present, **kwargs):
+        """AWS IoT SDK reconnect finished, hand a rejected one to the reconnect worker"""
+        if return_code != mqtt.ConnectReturnCode.ACCEPTED:
+            print(f"AWS IoT reconnect rejected: {return_code}")
+            self._reconnect_evt.set()
+            return
+
+        print("AWS IoT connection resumed")
+        self.connected = True
+        self._dirty = True
+
+        # The broker dropped the session, subscribe to garage/state again
+        if not session_present:
+            connection.resubscribe_existing_topics()
+
+    def connect_aws_with_backoff(self):
+        """Connect via the AWS IoT SDK, backing off exponentially between failed attempts"""
+        hinted = False
+        while self.running and not self.connected:
+            self.connection_attempts += 1
+            try:
+                # A slow connect is still in progress, keep waiting on it instead of connecting again
+                connect_future = self.mqtt_connection.connect()
+                while True:
+                    try:
+                        connect_future.result(timeout=10)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        if not hinted:
+                            self.check_connection_timeout()
+                            hinted = True
+                        if not self.running:
+                            return
+
+                print("AWS IoT connection successful!")
+                self.connected = True
+                self._dirty = True
+                self._backoff = 2
+
+                # Subscribe to garage state topic
+                subscribe_future, packet_id = self.mqtt_connection.subscribe(
+                    topic="garage/state",
+                    qos=mqtt.QoS.AT_LEAST_ONCE,
+                    callback=self.on_aws_message_received
+                )
+                print("Subscribed to garage/state topic")
+                return
+
+            except Exception as e:
+                print(f"AWS IoT connection attempt {self.connection_attempts} failed: {e!r}")
+                if self.connection_attempts >= self.max_connection_attempts:
+                    print("Falling back to paho-mqtt...")
+                    self.setup_paho_mqtt_connection()
+                    return
+
+                print(f"Retrying in {self._backoff} seconds...")
+                time.sleep(self._backoff)
+                self._backoff = min(self._backoff * 2, self._backoff_max)
 
     def on_aws_message_received(self, topic, payload, **kwargs):
         """Handle AWS IoT SDK messages"""
         try:
-            message = json.loads(payload.decode())
-            self.process_message(message)
+            if not self._first_seen(hash_payload(bytes(payload))):
+                return  # Duplicate of a recently processed payload
+
+            token, state = self.extract_fields(payload)
+            self.process_message(token, state)
         except Exception as e:
-            print(f"Error processing AWS IoT message: {e}")
+            log.warning("Error processing AWS IoT message: %s", e)
 
     def on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback for paho-mqtt connection"""
         if rc != 0:
             print(f"Failed to connect to AWS IoT. Return code: {rc}")
             self.connected = False
+            self._dirty = True
             return
 
         print("Paho-MQTT connection successful!")
         self.connected = True
+        self._dirty = True
+
+        # Disable Nagle's algorithm for lower latency on small state messages
+        try:
+            client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError) as e:
+            print(f"Could not set TCP_NODELAY: {e}")
+
         client.subscribe("garage/state")
         print("Subscribed to garage/state topic")
 
@@ -208,88 +375,169 @@ class GarageSimulator:
         else:
             print(f"Unexpected disconnection from AWS IoT (code: {rc})")
         self.connected = False
+        self._dirty = True
 
     def on_message(self, client, userdata, msg):
         """Handle paho-mqtt messages"""
         try:
-            payload = json.loads(msg.payload.decode())
-            self.process_message(payload)
+            if not self._first_seen(hash_payload(bytes(msg.payload))):
+                return  # Duplicate of a recently processed payload
+
+            token, state = self.extract_fields(msg.payload)
+            self.process_message(token, state)
         except Exception as e:
-            print(f"Error processing paho-mqtt message: {e}")
+            log.warning("Error processing paho-mqtt message: %s", e)
+
+    def local_state_listener(self):
+        """Receive garage/state messages from the controller's local ZeroMQ publisher"""
+        sock = zmq.Context.instance().socket(zmq.SUB)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.SUBSCRIBE, b"garage/state")
+        sock.connect(LOCAL_STATE_ENDPOINT)
+        print(f"Listening for local state on {LOCAL_STATE_ENDPOINT}")
 
-    def process_message(self, payload):
+        try:
+            while self.running:
+                if not sock.poll(500):
+                    continue
+
+                _, payload = sock.recv_multipart()
+                if not self._first_seen(hash_payload(payload)):
+                    continue  # Already delivered over MQTT
+
+                try:
+                    token, state = self.extract_fields(payload)
+                except Exception as e:
+                    log.warning("Error processing local message: %s", e)
+                    continue
+                self.process_message(token, state)
+        except zmq.ZMQError as e:
+            log.warning("Local state listener stopped: %s", e)
+        finally:
+            sock.close()
+
+    def _first_seen(self, payload_hash):
+        """Record a payload hash, False if it is among the last few already processed"""
+        with self._recent_lock:
+            if payload_hash in self._recent_set:
+                return False
+
+            # Forget the oldest hash once the window is full
+            if len(self._recent_hashes) == self._recent_hashes.maxlen:
+                self._recent_set.discard(self._recent_hashes[0])
+            self._recent_hashes.append(payload_hash)
+            self._recent_set.add(payload_hash)
+            return True
+
+    def extract_fields(self, payload):
+        """Extract the token and state fields as bytes from a raw JSON payload"""
+        # Regex matches are only trusted on a flat object, where a key cannot hide in a nested one
+        if payload.count(b'{') == 1:
+            token = self._TOKEN_RE.search(payload)
+            state = self._STATE_RE.search(payload)
+
+            # Escaped values still need JSON decoding, leave those to the full parse
+            if token and state and b'\\' not in token.group(1) and b'\\' not in state.group(1):
+                return token.group(1), state.group(1)
+
+        # Fall back to a full parse for nested, escaped or unusual payloads
+        if self._decoder is not None:
+            message = self._decoder.decode(payload)
+
+            # An empty state is still a state, only a missing key maps to None
+            return (message.token.encode() if message.token is not None else None,
+                    message.state.encode() if message.state is not None else None)
+
+        message = json_loads(payload)
+        token = message.get('token')
+        state = message.get('state')
+        return (token.encode() if isinstance(token, str) else None,
+                state.encode() if isinstance(state, str) else None)
+
+    def process_message(self, token, state):
         """Common message processing for both MQTT clients"""
         try:
-            # Validate token for security
-            if payload.get('token') != garage_config.SECRET_TOKEN:
-                print("Invalid token in message - ignoring")
+            # Validate token for security with a constant-time comparison
+            if token is None or not hmac.compare_digest(token, self._token_bytes):
+                log.debug("Invalid token in message - ignoring")
                 return
 
-            # Process state change
-            if "state" in payload:
-                new_state = (payload["state"] == "open")
-                if new_state != self.door_open:
-                    print(f"Changing door state from {self.door_open} to {new_state}")
-                    self.door_open = new_state
+            # Queue the state change for the render loop
+            if state is not None:
+                self._pending.append(state == b"open")
             else:
-                print("Warning: 'state' field missing in payload")
+                log.debug("'state' field missing in payload")
 
         except Exception as e:
-            print(f"Error processing message: {e}")
+            log.warning("Error processing message: %s", e)
 
-    def draw_garage(self):
-        """Draw the garage door simulation"""
-        # Clear screen
-        self.screen.fill((30, 30, 40))
+    def render_background(self):
+        """Pre-render the static garage geometry into a cached surface"""
+        background = pygame.Surface(self.screen.get_size()).convert()
+        background.fill((30, 30, 40))
 
         # Garage frame (outer structure)
-        pygame.draw.rect(self.screen, (80, 80, 90), (150, 100, 300, 450), 0)
-        pygame.draw.rect(self.screen, (60, 60, 70), (150, 100, 300, 450), 4)
+        pygame.draw.rect(background, (80, 80, 90), (150, 100, 300, 450), 0)
+        pygame.draw.rect(background, (60, 60, 70), (150, 100, 300, 450), 4)
+
+        # Door tracks (vertical guides)
+        pygame.draw.rect(background, (100, 100, 110), (150, 110, 10, 400), 0)
+        pygame.draw.rect(background, (100, 100, 110), (440, 110, 10, 400), 0)
+
+        # Status panel
+        pygame.draw.rect(background, (40, 40, 50), (0, 0, 600, 80), 0)
+        pygame.draw.line(background, (70, 70, 80), (0, 80), (600, 80), 2)
+
+        # Instructions
+        self._instr_text = self._font_small.render("Press O to Open, C to Close, ESC to Exit", True, (180, 180, 200))
+        background.blit(self._instr_text, (10, 55))
+
+        return background
+
+    def _render(self, font, text, color):
+        """Render text once and reuse the surface on later calls"""
+        key = (font, text, color)
+        surface = self._text_cache.get(key)
+        if surface is None:
+            surface = font.render(text, True, color).convert_alpha()
+            self._text_cache[key] = surface
+        return surface
+
+    def draw_garage(self):
+        """Draw the garage door simulation"""
+        # Static frame, tracks, status panel and instructions
+        self.screen.blit(self._bg, (0, 0))
 
         # Garage door (moves up when opening)
+        dh = int(self.door_height)  # Integer coordinates keep SDL on its fast paths
         door_color = (180, 190, 200) if self.door_open else (150, 160, 170)
-        door_rect = pygame.Rect(160, 110 + self.door_height, 280, 400 - self.door_height)
+        door_rect = pygame.Rect(160, 110 + dh, 280, 400 - dh)
         pygame.draw.rect(self.screen, door_color, door_rect, 0)
         pygame.draw.rect(self.screen, (100, 100, 110), door_rect, 2)
 
         # Door panels (visual detail)
-        if self.door_height < 400:
-            panel_height = max(20, (400 - self.door_height) // 5)
+        if dh < 400:
+            panel_height = max(20, (400 - dh) // 5)
+            base = 110 + dh
             for i in range(5):
-                y_pos = 110 + self.door_height + (i * panel_height)
+                y_pos = base + i * panel_height
                 if y_pos < 510:
-                    pygame.draw.line(self.screen, (120, 130, 140),
-                                     (170, y_pos), (430, y_pos), 3)
-
-        # Door tracks (vertical guides)
-        pygame.draw.rect(self.screen, (100, 100, 110), (150, 110, 10, 400), 0)
-        pygame.draw.rect(self.screen, (100, 100, 110), (440, 110, 10, 400), 0)
-
-        # Status panel
-        pygame.draw.rect(self.screen, (40, 40, 50), (0, 0, 600, 80), 0)
-        pygame.draw.line(self.screen, (70, 70, 80), (0, 80), (600, 80), 2)
+                    pygame.draw.line(self.screen, (120, 130, 140), (170, y_pos), (430, y_pos), 3)
 
         # Status text
-        font = pygame.font.SysFont(None, 48)
         status = "OPEN" if self.door_open else "CLOSED"
         color = (50, 200, 50) if self.door_open else (220, 50, 50)
-        text = font.render(f"GARAGE: {status}", True, color)
+        text = self._render(self._font_big, f"GARAGE: {status}", color)
         self.screen.blit(text, (250, 15))
 
         # Connection status
-        status_font = pygame.font.SysFont(None, 28)
         conn_status = "CONNECTED" if self.connected else "OFFLINE"
         conn_color = (50, 200, 50) if self.connected else (220, 50, 50)
-        conn_text = status_font.render(f"MQTT: {conn_status}", True, conn_color)
+        conn_text = self._render(self._font_med, f"MQTT: {conn_status}", conn_color)
         self.screen.blit(conn_text, (10, 15))
 
-        # Instructions
-        instr_font = pygame.font.SysFont(None, 24)
-        instr_text = instr_font.render("Press O to Open, C to Close, ESC to Exit", True, (180, 180, 200))
-        self.screen.blit(instr_text, (10, 55))
-
-        # Door position indicator
-        pos_text = status_font.render(f"Position: {400 - self.door_height}/400", True, (200, 200, 220))
+        # Door position indicator (changes while animating, so not cached)
+        pos_text = self._font_med.render(f"Position: {400 - dh}/400", True, (200, 200, 220))
         self.screen.blit(pos_text, (20, 550))
 
     def run(self):
@@ -297,38 +545,60 @@ class GarageSimulator:
         print("Starting Garage Door Simulator")
         print("Press O to Open, C to Close, ESC to exit")
 
+        full_redraw = True
+        idle = False
+
         while self.running:
-            current_time = time.time()
-            delta_time = current_time - self.last_update_time
-            self.last_update_time = current_time
+            # Cap at 60 FPS (10 FPS when idle) and use the elapsed frame time for animation
+            delta_time = self.clock.tick(10 if idle else 60) * 0.001
+
+            # Apply door states received from MQTT since the last frame
+            while self._pending:
+                new_state = self._pending.popleft()
+                if new_state != self.door_open:
+                    print(f"Changing door state from {self.door_open} to {new_state}")
+                    self.door_open = new_state
+                    self._dirty = True
 
             # Handle events
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     self.running = False
+                elif event.type == pygame.VIDEOEXPOSE:
+                    full_redraw = True
+                    self._dirty = True
                 elif event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         self.running = False
                     elif event.key == pygame.K_o:
                         self.door_open = True
+                        self._dirty = True
                         print("Manual command: OPEN")
                     elif event.key == pygame.K_c:
                         self.door_open = False
+                        self._dirty = True
                         print("Manual command: CLOSE")
 
-            # Smooth door animation with time-based movement
+            # Smooth door animation with time-based movement, skipped while at rest
             target_height = 400 if self.door_open else 0
-            movement = 200 * delta_time
-
-            if self.door_height < target_height:
-                self.door_height = min(self.door_height + movement, target_height)
-            elif self.door_height > target_height:
-                self.door_height = max(self.door_height - movement, target_height)
-
-            # Draw everything
-            self.draw_garage()
-            pygame.display.flip()
-            self.clock.tick(60)
+            if self.door_height != target_height:
+                movement = 200 * delta_time
+                if self.door_height < target_height:
+                    self.door_height = min(self.door_height + movement, target_height)
+                else:
+                    self.door_height = max(self.door_height - movement, target_height)
+                self._dirty = True
+
+            # Only redraw when something changed since the last frame
+            idle = not self._dirty
+            if self._dirty:
+                self._dirty = False
+                self.draw_garage()
+                if full_redraw:
+                    pygame.display.flip()
+                    full_redraw = False
+                else:
+                    pygame.display.update(self._dirty_rects)
 
         # Cleanup
         self.shutdown()
@@ -337,6 +607,7 @@ class GarageSimulator:
         """Clean shutdown of the simulator"""
         print("Shutting down garage simulator...")
         self.running = False
+        self._reconnect_evt.set()
 
         try:
             if USE_AWS_SDK and hasattr(self, 'mqtt_connection') and self.connected:
@@ -353,6 +624,7 @@ class GarageSimulator:
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     try:
         simulator = GarageSimulator()
         simulator.run()
@@ -1,31 +1,322 @@
 # Main Controller for Garage System
+import os
+
+# Leave a core for the capture, MQTT and voice threads, OpenMP reads this when OpenCV loads
+CV_THREADS = max(1, (os.cpu_count() or 1) - 1)
+os.environ.setdefault("OMP_NUM_THREADS", str(CV_THREADS))
+
 import json
+import logging
 import time
 import threading
+import concurrent.futures
+import multiprocessing
+import queue
 import cv2
+import numpy as np
 import pyaudio
 import speech_recognition as sr
 import paho.mqtt.client as mqtt
 import boto3
 import garage_config
-import os
 import subprocess
 import sys
 import ssl
+import signal
+from multiprocessing import shared_memory
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+logger = logging.getLogger("garage")
+
+# Optimized code paths on, worker threads capped to match OMP_NUM_THREADS
+cv2.setUseOptimized(True)
+cv2.setNumThreads(CV_THREADS)
+
+# Prefer orjson for encoding and decoding payloads, fallback to the standard library
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+    json_loads = json.loads
+
+# Prefer offline speech-gated recognition, fallback to SpeechRecognition with Google
+try:
+    import webrtcvad
+    import vosk
+    USE_OFFLINE_VOICE = True
+except ImportError:
+    USE_OFFLINE_VOICE = False
+
+# Optional local channel that mirrors state messages to the simulator without the cloud round trip
+try:
+    import zmq
+    USE_ZMQ = True
+except ImportError:
+    USE_ZMQ = False
+
+# Prefer a numba-compiled plate box selector, fallback to vectorized numpy
+try:
+    from numba import njit
+
+    @njit(cache=True, nogil=True)
+    def best_plate_bbox(boxes, min_area, max_area, min_aspect, max_aspect):
+        """Index of the largest plate-proportioned (x, y, w, h) box within the area range, -1 if none"""
+        best = -1
+        best_area = 0
+        for i in range(boxes.shape[0]):
+            w = boxes[i, 2]
+            h = boxes[i, 3]
+            area = w * h
+            if h > 0 and min_aspect * h < w < max_aspect * h and min_area <= area <= max_area and area > best_area:
+                best = i
+                best_area = area
+        return best
+except ImportError:
+    def best_plate_bbox(boxes, min_area, max_area, min_aspect, max_aspect):
+        """Index of the largest plate-proportioned (x, y, w, h) box within the area range, -1 if none"""
+        w = boxes[:, 2]
+        h = boxes[:, 3]
+        area = w * h
+        ok = (h > 0) & (w > min_aspect * h) & (w < max_aspect * h) & (area >= min_area) & (area <= max_area)
+        if not ok.any():
+            return -1
+        return int(np.argmax(np.where(ok, area, -1)))
+
+# Prefer cachetools for the plate lookup cache, fallback to a minimal dict-based version
+try:
+    from cachetools import TLRUCache
+except ImportError:
+    class TLRUCache:
+        """LRU cache with a per-item expiry time, the subset of cachetools.TLRUCache used here"""
+
+        def __init__(self, maxsize, ttu, timer=time.monotonic):
+            self.maxsize = maxsize
+            self._ttu = ttu
+            self._timer = timer
+            self._data = {}  # key -> (value, expiry), ordered from least to most recently used
+
+        def get(self, key, default=None):
+            item = self._data.pop(key, None)
+            if item is None or self._timer() >= item[1]:
+                return default
+            self._data[key] = item
+            return item[0]
+
+        def __setitem__(self, key, value):
+            self._data.pop(key, None)
+            self._data[key] = (value, self._ttu(key, value, self._timer()))
+            while len(self._data) > self.maxsize:
+                self._data.pop(next(iter(self._data)))
+
+        def __len__(self):
+            return len(self._data)
+
+# Bytes stripped from detected plate text, everything except ASCII letters and digits
+_NON_ALNUM = bytes(b for b in range(256) if not (chr(b).isascii() and chr(b).isalnum()))
+
+# Local state endpoint shared with the simulator, ipc sockets are not available on Windows
+LOCAL_STATE_ENDPOINT = getattr(garage_config, 'LOCAL_STATE_ENDPOINT',
+                               "tcp://127.0.0.1:5556" if sys.platform == "win32" else "ipc:///tmp/garage.sock")
+
+
+class LatestFrame:
+    """Single-slot frame buffer, a new frame replaces any frame not yet taken"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+
+    def put(self, frame):
+        """Store the newest frame, returns the replaced frame if it was never taken"""
+        with self._cond:
+            stale, self._frame = self._frame, frame
+            self._cond.notify()
+        return stale
+
+    def get(self, timeout=None):
+        """Wait for the newest frame and take it, returns None on timeout"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._frame is not None, timeout):
+                return None
+            frame, self._frame = self._frame, None
+            return frame
+
+
+class MotionDetector:
+    """MOG2 motion detector working on a downscaled copy of each frame"""
+
+    def __init__(self, size, min_area):
+        self.size = size
+        self.min_area = min_area  # In full-resolution pixels
+        self._bgsub = cv2.createBackgroundSubtractorMOG2(history=500, varThreshold=25, detectShadows=False)
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+        # Working images are reused across frames, every step writes into its own buffer
+        self._small = np.empty((size[1], size[0], 3), np.uint8)
+        self._foreground = np.empty((size[1], size[0]), np.uint8)
+        self._opened = np.empty_like(self._foreground)
+        self._dilated = np.empty_like(self._foreground)
+
+    def detect(self, frame):
+        """Return the (x, y, w, h) box of the largest moving region or None"""
+        # Work on a small copy, coarse motion survives the downscale
+        height, width = frame.shape[:2]
+        scale_x = width / self.size[0]
+        scale_y = height / self.size[1]
+        small = cv2.resize(frame, self.size, dst=self._small, interpolation=cv2.INTER_AREA)
+
+        # Adaptive background model, tolerant of gradual lighting changes
+        foreground = self._bgsub.apply(small, fgmask=self._foreground)
+        foreground = cv2.morphologyEx(foreground, cv2.MORPH_OPEN, self._kernel, dst=self._opened)
+
+        # Cheap pixel count first, quiet frames never reach contour extraction
+        if cv2.countNonZero(foreground) * scale_x * scale_y <= self.min_area:
+            return None
+
+        foreground = cv2.dilate(foreground, None, dst=self._dilated, iterations=2)
+
+        contours, _ = cv2.findContours(foreground, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        largest = max(contours, key=cv2.contourArea, default=None)
+        if largest is not None and cv2.contourArea(largest) * scale_x * scale_y > self.min_area:
+            x, y, w, h = cv2.boundingRect(largest)
+            return (int(x * scale_x), int(y * scale_y), int(w * scale_x), int(h * scale_y))
+
+        return None
+
+
+# First message from the detector process, sent once it is ready for requests
+MOTION_READY = "ready"
+
+
+def motion_process(shm_name, shape, requests, results, size, min_area):
+    """Detector process, answers each request with the motion box of the shared frame"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    detector = MotionDetector(size, min_area)
+    try:
+        # Tell the parent startup is done, under spawn this follows a full re-import of the module
+        results.put(MOTION_READY)
+
+        # The parent writes the frame before each request and waits for the answer
+        while requests.get() is not None:
+            try:
+                results.put(detector.detect(frame))
+            except cv2.error:
+                results.put(None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del frame
+        shm.close()
+
 
 class GarageSystem:
+    # Plate authorization cache: seconds to trust a lookup and maximum entries kept
+    PLATE_CACHE_TTL = 60.0
+    PLATE_CACHE_NEGATIVE_TTL = 10.0
+    PLATE_CACHE_SIZE = 128
+
+    # Rekognition uploads: plate crop width and JPEG quality
+    UPLOAD_MAX_WIDTH = 320
+    UPLOAD_JPEG_QUALITY = 82
+
+    # Plate candidate prefilter: working width, bounding box aspect ratio and area in prefilter pixels
+    PREFILTER_MAX_WIDTH = 640
+    PLATE_ASPECT_RANGE = (2.0, 6.0)
+    PLATE_MIN_AREA = 2000
+    PLATE_MAX_AREA = 20000
+
+    # Requested capture format, detection does not need more
+    CAMERA_WIDTH = 1280
+    CAMERA_HEIGHT = 720
+    CAMERA_FPS = 15
+
+    # Capture buffers allocated up front, more are added only if all are held downstream
+    FRAME_BUFFERS = 5
+
+    # Preview refresh interval in seconds and maximum display width
+    PREVIEW_INTERVAL = 0.1
+    PREVIEW_MAX_WIDTH = 640
+
+    # Motion detection runs on a downscaled copy of each frame
+    MOTION_SIZE = (320, 180)
+    MOTION_MIN_AREA = 5000  # In full-resolution pixels
+    MOTION_START_TIMEOUT = 60.0  # Seconds allowed for the detector process to start
+
+    # Voice command grammar
+    _OPEN_KEYS = frozenset({'open', 'garage'})
+    _CLOSE_KEYS = frozenset({'close', 'shut'})
+    _GARAGE = frozenset({'garage', 'door'})
+
+    # Offline voice capture: 16 kHz mono in 20 ms frames, an utterance ends after 500 ms of silence
+    VOICE_RATE = 16000
+    VOICE_FRAME_MS = 20
+    VOICE_SILENCE_MS = 500
+    VOICE_MAX_MS = 5000
+    VOSK_MODEL_PATH = "vosk-model-small-en-us"
+
+    # Seconds an opened door stays open before closing automatically
+    AUTO_CLOSE_DELAY = 300.0
+
+    # Largest accepted garage/control payload in bytes
+    MAX_COMMAND_PAYLOAD = 1024
+
+    # Seconds a control command stays valid, the persistent session can replay commands queued long ago
+    COMMAND_MAX_AGE = 30.0
+
+    # Plate checks run one at a time (see _inflight_plate), also sizes each AWS client's connection pool
+    PLATE_WORKERS = 1
+
     def __init__(self):
         self.door_open = False
-        self.auto_close_timer = None
+        # Authorized plates are trusted longer than unknown ones
+        self._plate_cache = TLRUCache(
+            maxsize=self.PLATE_CACHE_SIZE,
+            ttu=lambda plate, authorized, now: now + (self.PLATE_CACHE_TTL if authorized else self.PLATE_CACHE_NEGATIVE_TTL),
+            timer=time.monotonic
+        )
+        self._plate_cache_lock = threading.Lock()
+
+        # Preformatted state message, the token is JSON-encoded once up front
+        self._state_template = b'{"state":"%s","timestamp":%d,"token":%s}'
+        self._token_b = json_dumps(garage_config.SECRET_TOKEN)
+
+        # Latest pending message per topic, flushed by the publisher thread
+        self._pub_queue = {}
+        self._pub_lock = threading.Lock()
+        self._pub_evt = threading.Event()
+
+        # Commands run off the MQTT network thread, created before the client connects
+        # A single worker keeps commands in delivery order, an open followed by a close must not swap
+        self._cmd_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="mqtt-cmd")
+
+        # Plate recognition runs off the capture thread, one check in flight at a time
+        self._plate_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.PLATE_WORKERS, thread_name_prefix="plate")
+        self._inflight_plate = None
+        self._last_detection_time = float('-inf')  # time.monotonic() of the last authorized plate
+        self._close_deadline = 0.0  # time.monotonic() to auto-close at, 0 when not scheduled
+        self._close_lock = threading.Lock()
+        self._close_evt = threading.Event()
         self.mqtt_client = self.setup_mqtt()
         self.preview_enabled = True
         self.preview_window_name = "Camera Preview"
+        self._preview_slot = None  # Newest frame for the main thread to display
+        self._preview_lock = threading.Lock()
+        self._preview_shown = False
+        self._preview_buf = None  # Reused destination for the downscaled preview
+        self._last_preview_t = 0.0
+        self._overlay = None  # Pre-rendered preview hint (sprite, mask, origin)
         self.shutdown_event = threading.Event()
         self.simulator_process = None
         self.camera_available = False
         self.voice_available = False
+        self._motion = MotionDetector(self.MOTION_SIZE, self.MOTION_MIN_AREA)  # In-process fallback
+        self._motion_proc = None
 
         # Launch simulator automatically
         self.launch_simulator()
@@ -36,19 +327,41 @@ class GarageSystem:
         # Initialize speech recognition
         self.initialize_voice_recognition()
 
+        # Initialize AWS clients for plate recognition
+        self.initialize_aws_clients()
+
+        # Motion detection runs in its own process, off this interpreter's GIL
+        if self.camera_available:
+            self.start_motion_process(self._frame_shape)
+
         # Start subsystems
+        threading.Thread(target=self.publish_loop, daemon=True).start()
+        threading.Thread(target=self.auto_close_worker, daemon=True).start()
+        self._latest_frame = LatestFrame()
+
+        # Frames are captured into recycled buffers, returned here once the detector and preview are done
+        self._free_frames = queue.SimpleQueue()
+        if self.camera_available:
+            for _ in range(self.FRAME_BUFFERS):
+                self._free_frames.put(np.empty(self._frame_shape, np.uint8))
         threading.Thread(target=self.camera_monitor, daemon=True).start()
+        if self.camera_available:
+            threading.Thread(target=self.detection_monitor, daemon=True).start()
         if self.voice_available:
             threading.Thread(target=self.voice_monitor, daemon=True).start()
 
-        # Start MQTT loop
-        try:
-            threading.Thread(target=self.mqtt_client.loop_forever, daemon=True).start()
-        except Exception as e:
-            print(f"Error starting MQTT loop: {e}")
+        # Headless toggle for the preview, the window itself handles 'p' and 'q'
+        self._wake = threading.Event()
+        self._quit = threading.Event()  # Quit requested off the main thread, run() shuts down
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_preview())
+
+        # The same keys from the terminal, read by a thread that blocks between keystrokes
+        self._restore_terminal = None
+        if sys.stdin is not None and sys.stdin.isatty():
+            self.start_terminal_keys()
 
-        print("Garage System Started. Press 'p' to toggle preview, 'q' to exit.")
-        threading.Thread(target=self.check_keyboard_input, daemon=True).start()
+        print("Garage System Started. Press 'p' to toggle the preview, 'q' to exit.")
 
     def launch_simulator(self):
         """Launch the garage simulator automatically"""
@@ -81,16 +394,37 @@ class GarageSystem:
     def initialize_camera(self):
         """Initialize the Logitech 720 external camera"""
         try:
+            # Pick the native capture backend for the platform
+            if sys.platform == "win32":
+                backend = cv2.CAP_DSHOW
+            elif sys.platform.startswith("linux"):
+                backend = cv2.CAP_V4L2
+            else:
+                backend = cv2.CAP_ANY
+
             # Try common camera indices
             for index in [1, 2, 0, 3, 4]:
                 try:
-                    camera = cv2.VideoCapture(index)
+                    camera = cv2.VideoCapture(index, backend)
                     if camera.isOpened():
+                        # Ask for MJPG so the camera compresses on-chip instead of sending raw YUYV
+                        camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+                        camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.CAMERA_WIDTH)
+                        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.CAMERA_HEIGHT)
+                        camera.set(cv2.CAP_PROP_FPS, self.CAMERA_FPS)
+
+                        # Keep only the newest frame queued in the driver
+                        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
                         ret, frame = camera.read()
                         if ret and frame is not None:
                             self.camera = camera
                             self.camera_available = True
-                            print(f"Camera initialized at index {index}")
+                            self._frame_shape = frame.shape
+                            fourcc = int(camera.get(cv2.CAP_PROP_FOURCC)).to_bytes(4, 'little')
+                            print(f"Camera initialized at index {index}: "
+                                  f"{int(camera.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))} "
+                                  f"@ {camera.get(cv2.CAP_PROP_FPS):.0f} fps ({fourcc.decode(errors='replace')})")
                             return
                     camera.release()
                 except:
@@ -104,6 +438,20 @@ class GarageSystem:
 
     def initialize_voice_recognition(self):
         """Initialize speech recognition system"""
+        self.voice_offline = False
+        if USE_OFFLINE_VOICE:
+            try:
+                model_path = getattr(garage_config, 'VOSK_MODEL_PATH', self.VOSK_MODEL_PATH)
+                self._vosk_model = vosk.Model(model_path)
+                self._vad = webrtcvad.Vad(2)
+                self._audio = pyaudio.PyAudio()
+                self.voice_offline = True
+                self.voice_available = True
+                print(f"Offline voice recognition initialized ({model_path})")
+                return
+            except Exception as e:
+                print(f"Offline voice init error, using online recognition: {e}")
+
         try:
             self.recognizer = sr.Recognizer()
             self.microphone = sr.Microphone()
@@ -113,6 +461,90 @@ class GarageSystem:
             print(f"Voice init error: {e}")
             self.voice_available = False
 
+    def initialize_aws_clients(self):
+        """Create the Rekognition client and DynamoDB table handle once for reuse"""
+        self._rekognition = None
+        self._plates_table = None
+        try:
+            # Each client builds its own pool from this, sized to the plate workers with TCP keepalive
+            aws_config = Config(max_pool_connections=self.PLATE_WORKERS, tcp_keepalive=True)
+
+            self._rekognition = boto3.client(
+                'rekognition',
+                aws_access_key_id=garage_config.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=garage_config.AWS_SECRET_ACCESS_KEY,
+                region_name=garage_config.AWS_REGION,
+                config=aws_config
+            )
+
+            dynamodb = boto3.resource(
+                'dynamodb',
+                aws_access_key_id=garage_config.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=garage_config.AWS_SECRET_ACCESS_KEY,
+                region_name=garage_config.AWS_REGION,
+                config=aws_config
+            )
+            self._plates_table = dynamodb.Table(garage_config.AUTHORIZED_PLATES_TABLE)
+            print("AWS clients initialized")
+        except Exception as e:
+            print(f"AWS client init error: {e}")
+            self._rekognition = None
+            self._plates_table = None
+
+    def start_motion_process(self, shape):
+        """Start the detector process and the shared frame buffer it reads from"""
+        try:
+            self._motion_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+            self._motion_frame = np.ndarray(shape, dtype=np.uint8, buffer=self._motion_shm.buf)
+            # Spawn on every platform, forking after paho and the other threads started is unsafe
+            ctx = multiprocessing.get_context("spawn")
+            self._motion_requests = ctx.Queue()
+            self._motion_results = ctx.Queue()
+            self._motion_proc = ctx.Process(
+                target=motion_process,
+                args=(self._motion_shm.name, shape, self._motion_requests, self._motion_results,
+                      self.MOTION_SIZE, self.MOTION_MIN_AREA),
+                daemon=True
+            )
+            self._motion_proc.start()
+
+            # Wait for the ready marker so the per-request timeout never has to cover startup
+            deadline = time.monotonic() + self.MOTION_START_TIMEOUT
+            while True:
+                try:
+                    if self._motion_results.get(timeout=0.5) == MOTION_READY:
+                        break
+                except queue.Empty:
+                    if not self._motion_proc.is_alive() or time.monotonic() > deadline:
+                        raise RuntimeError("detector process did not start")
+
+            print(f"Motion detector process started (pid {self._motion_proc.pid})")
+        except Exception as e:
+            print(f"Motion process unavailable, detecting in-process: {e}")
+            self.stop_motion_process()
+
+    def stop_motion_process(self):
+        """Stop the detector process and release the shared frame buffer"""
+        proc, self._motion_proc = self._motion_proc, None
+        if proc is not None:
+            try:
+                self._motion_requests.put(None)
+                proc.join(timeout=1.0)
+                if proc.is_alive():
+                    proc.terminate()
+            except Exception:
+                pass
+
+        shm = getattr(self, '_motion_shm', None)
+        if shm is not None:
+            self._motion_shm = None
+            self._motion_frame = None
+            try:
+                shm.close()
+                shm.unlink()
+            except Exception:
+                pass
+
     def setup_mqtt(self):
         """Setup MQTT with robust connection handling and correct certificate files"""
         try:
@@ -139,11 +571,12 @@ class GarageSystem:
             try:
                 client = mqtt.Client(
                     client_id="garage_controller",
+                    clean_session=False,
                     callback_api_version=mqtt.CallbackAPIVersion.VERSION2
                 )
             except (AttributeError, NameError):
                 print("Using older paho-mqtt API")
-                client = mqtt.Client(client_id="garage_controller")
+                client = mqtt.Client(client_id="garage_controller", clean_session=False)
 
             client.on_connect = self.on_connect
             client.on_disconnect = self.on_disconnect
@@ -190,81 +623,97 @@ class GarageSystem:
             return
 
         print("Connected to AWS IoT")
-        client.subscribe("garage/control")
+        client.subscribe("garage/control", qos=1)
+
+        # Replace the broker's retained state from a previous run with the controller's actual state
+        self._publish_state(b"open" if self.door_open else b"closed")
 
     def on_disconnect(self, client, userdata, flags, reason_code, properties=None):
         if reason_code != 0:
             print(f"Unexpected disconnect: {reason_code}")
 
     def on_message(self, client, userdata, msg, properties=None):
+        # Commands are tiny, anything larger is rejected without parsing
+        if len(msg.payload) > self.MAX_COMMAND_PAYLOAD:
+            print("Oversized MQTT payload rejected")
+            return
+
         try:
-            payload = json.loads(msg.payload.decode())
+            payload = json_loads(msg.payload)
 
             # Validate token
             if payload.get('token') != garage_config.SECRET_TOKEN:
                 print("Invalid token rejected")
                 return
 
-            # Process commands
             command = payload.get('command', '')
-            if command == 'open' and not self.door_open:
-                self.open_door()
-            elif command == 'close' and self.door_open:
-                self.close_door()
-        except:
-            print("Invalid MQTT payload")
 
-    def detect_motion(self, frame):
-        """Simple motion detection"""
-        try:
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
+            # Commands carry their send time, reject stale ones instead of acting on them
+            age = time.time() - payload['timestamp']
+        except KeyError:
+            print("Command without timestamp rejected")
+            return
+        except (ValueError, AttributeError, TypeError):
+            print("Invalid MQTT payload")
+            return
 
-            if not hasattr(self, 'last_frame') or self.last_frame is None:
-                self.last_frame = gray
-                return False
+        if not abs(age) <= self.COMMAND_MAX_AGE:  # Written so a NaN timestamp fails too
+            print(f"Stale command rejected ({age:.0f}s old)")
+            return
 
-            frame_delta = cv2.absdiff(self.last_frame, gray)
-            thresh = cv2.threshold(frame_delta, 25, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.dilate(thresh, None, iterations=2)
+        # Process commands on the worker pool so MQTT delivery is never held up
+        self._cmd_pool.submit(self._handle_command, command)
 
-            contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    def _handle_command(self, command):
+        """Dispatch a validated MQTT command"""
+        if command == 'open' and not self.door_open:
+            self.open_door()
+        elif command == 'close' and self.door_open:
+            self.close_door()
 
-            for contour in contours:
-                if cv2.contourArea(contour) > 5000:
-                    return True
+    def detect_motion(self, frame):
+        """Motion box for the frame, from the detector process when it is running"""
+        if self._motion_proc is not None and frame.shape == self._motion_frame.shape:
+            np.copyto(self._motion_frame, frame)
+            self._motion_requests.put(True)
+            try:
+                return self._motion_results.get(timeout=1.0)
+            except queue.Empty:
+                print("Motion process not responding, detecting in-process")
+                self.stop_motion_process()
 
-            self.last_frame = gray
-            return False
-        except:
-            return False
+        try:
+            return self._motion.detect(frame)
+        except cv2.error:
+            return None
 
     def process_plate(self, frame):
         """Detect and validate license plate"""
+        if self._rekognition is None or self._plates_table is None:
+            return False
+
         try:
-            # Create AWS clients
-            rekognition = boto3.client(
-                'rekognition',
-                aws_access_key_id=garage_config.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=garage_config.AWS_SECRET_ACCESS_KEY,
-                region_name=garage_config.AWS_REGION
-            )
+            # Only pay for a Rekognition call when something plate-shaped is in view
+            frame = self.find_plate_candidate(frame)
+            if frame is None:
+                return False
 
-            dynamodb = boto3.resource(
-                'dynamodb',
-                aws_access_key_id=garage_config.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=garage_config.AWS_SECRET_ACCESS_KEY,
-                region_name=garage_config.AWS_REGION
-            )
-            table = dynamodb.Table(garage_config.AUTHORIZED_PLATES_TABLE)
+            # Downscale the plate crop and recompress before upload, text detection saturates well below this
+            height, width = frame.shape[:2]
+            if width > self.UPLOAD_MAX_WIDTH:
+                scaled_height = int(height * self.UPLOAD_MAX_WIDTH / width)
+                frame = cv2.resize(frame, (self.UPLOAD_MAX_WIDTH, scaled_height), interpolation=cv2.INTER_AREA)
 
             # Convert frame to bytes
-            _, img_encoded = cv2.imencode('.jpg', frame)
-            response = rekognition.detect_text(Image={'Bytes': img_encoded.tobytes()})
+            ok, img_encoded = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.UPLOAD_JPEG_QUALITY])
+            if not ok:
+                return False
+            response = self._rekognition.detect_text(Image={'Bytes': img_encoded.tobytes()})
 
             # Find best plate candidate with proper type checking
             plates = []
             for t in response['TextDetections']:
+                logger.debug("Detected %s %r (%.1f%%)", t['Type'], t['DetectedText'], t['Confidence'])
                 if t['Type'] == 'LINE' and t['Confidence'] > 80:
                     plates.append(t['DetectedText'])
 
@@ -272,134 +721,434 @@ class GarageSystem:
                 return False
 
             # Clean and validate plate
-            plate_clean = ''.join(filter(str.isalnum, plates[0])).upper()
-            response = table.get_item(Key={'plate': plate_clean})
-            return 'Item' in response
+            plate_clean = plates[0].encode('ascii', 'ignore').translate(None, _NON_ALNUM).upper().decode()
+            return self._is_authorized(plate_clean)
 
         except Exception as e:
-            print(f"Plate processing error: {e}")
+            logger.warning("Plate processing error: %s", e)
             return False
 
+    def find_plate_candidate(self, frame):
+        """Return the most plate-like region of the frame, or None if nothing looks like a plate"""
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.PREFILTER_MAX_WIDTH / width)
+        small = frame if scale == 1.0 else cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        edges = cv2.Canny(gray, 100, 200)
+        contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+
+        if not contours:
+            return None
+
+        # Keep the largest wide, plate-proportioned box
+        boxes = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int32)
+        min_aspect, max_aspect = self.PLATE_ASPECT_RANGE
+        best = best_plate_bbox(boxes, self.PLATE_MIN_AREA, self.PLATE_MAX_AREA, min_aspect, max_aspect)
+        if best < 0:
+            return None
+
+        # Crop from the original resolution with a small margin
+        x, y, w, h = (int(v / scale) for v in boxes[best])
+        pad = 10
+        return frame[max(0, y - pad):y + h + pad, max(0, x - pad):x + w + pad]
+
+    def _is_authorized(self, plate_clean):
+        """Check a cleaned plate against DynamoDB, caching results for a short TTL"""
+        with self._plate_cache_lock:
+            authorized = self._plate_cache.get(plate_clean)
+        if authorized is not None:
+            return authorized
+
+        response = self._plates_table.get_item(Key={'plate': plate_clean})
+        authorized = 'Item' in response
+
+        with self._plate_cache_lock:
+            self._plate_cache[plate_clean] = authorized
+
+        return authorized
+
     def open_door(self):
         print("GARAGE DOOR OPENING")
         self.door_open = True
-        if self.auto_close_timer:
-            self.auto_close_timer.cancel()
-        self.auto_close_timer = threading.Timer(300.0, self.close_door)  # 5 minutes
-        self.auto_close_timer.start()
-        self.publish_door_state("open")
+        with self._close_lock:
+            self._close_deadline = time.monotonic() + self.AUTO_CLOSE_DELAY
+        self._close_evt.set()
+        self._publish_state(b"open")
 
     def close_door(self):
         print("GARAGE DOOR CLOSING")
         self.door_open = False
-        if self.auto_close_timer:
-            self.auto_close_timer.cancel()
-            self.auto_close_timer = None
-        self.publish_door_state("closed")
+        with self._close_lock:
+            self._close_deadline = 0.0
+        self._close_evt.set()
+        self._publish_state(b"closed")
+
+    def auto_close_worker(self):
+        """Close the door once the auto-close deadline passes, rescheduled by open_door"""
+        while not self.shutdown_event.is_set():
+            with self._close_lock:
+                deadline = self._close_deadline
+            self._close_evt.wait(max(0.0, deadline - time.monotonic()) if deadline else None)
+            self._close_evt.clear()
+
+            with self._close_lock:
+                due = self._close_deadline and time.monotonic() >= self._close_deadline
+            if due and not self.shutdown_event.is_set():
+                self.close_door()
+
+    def _publish_state(self, state_b):
+        """Queue the door state using the preformatted message template"""
+        payload = self._state_template % (state_b, int(time.time()), self._token_b)
+        self._queue_publish({'topic': "garage/state", 'payload': payload, 'qos': 0, 'retain': True})
+
+    def _queue_publish(self, msg):
+        """Queue a paho-style message dict, replacing any pending message on the same topic"""
+        with self._pub_lock:
+            self._pub_queue[msg['topic']] = msg
+        self._pub_evt.set()
+
+    def setup_local_publisher(self):
+        """Bind the local ZeroMQ state publisher, None when unavailable"""
+        if not USE_ZMQ:
+            return None
 
-    def publish_door_state(self, state):
         try:
-            payload = {
-                "state": state,
-                "timestamp": int(time.time()),
-                "token": garage_config.SECRET_TOKEN
-            }
-            self.mqtt_client.publish("garage/state", json.dumps(payload))
-        except:
-            print("Failed to publish state")
+            sock = zmq.Context.instance().socket(zmq.PUB)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.bind(LOCAL_STATE_ENDPOINT)
+            print(f"Local state publisher bound to {LOCAL_STATE_ENDPOINT}")
+            return sock
+        except zmq.ZMQError as e:
+            print(f"Local state publisher unavailable: {e}")
+            return None
+
+    def publish_loop(self):
+        """Flush queued messages, publishing at most one per topic every 50 ms"""
+        # ZeroMQ sockets are not thread-safe, this thread owns the local publisher
+        local = self.setup_local_publisher()
+
+        while not self.shutdown_event.is_set():
+            self._pub_evt.wait()
+            time.sleep(0.05)  # Coalescing window, rapid updates collapse to the latest
+            self._pub_evt.clear()
+
+            with self._pub_lock:
+                msgs, self._pub_queue = list(self._pub_queue.values()), {}
+
+            # Send the whole batch back to back so paho can write it out together
+            for msg in msgs:
+                # Local subscribers first, the simulator drops the duplicate arriving from AWS IoT
+                if local is not None:
+                    try:
+                        local.send_multipart([msg['topic'].encode(), msg['payload']], zmq.NOBLOCK)
+                    except zmq.ZMQError:
+                        pass
+
+                info = self.mqtt_client.publish(msg['topic'], msg['payload'], qos=msg['qos'], retain=msg['retain'])
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    print(f"Failed to publish {msg['topic']}: {mqtt.error_string(info.rc)}")
 
     def camera_monitor(self):
+        """Capture loop, keeps only the newest frame for the detector"""
         if not self.camera_available:
             print("Camera monitoring disabled")
             return
 
         print("Camera monitor started")
-        last_detection_time = 0
+
+        failures = 0
+        while not self.shutdown_event.is_set():
+            # Decode into a recycled buffer, read() allocates a new one only when all are in use
+            try:
+                buf = self._free_frames.get_nowait()
+            except queue.Empty:
+                buf = None
+
+            try:
+                ret, frame = self.camera.read(buf)
+            except cv2.error as e:
+                logger.warning("Camera read error: %s", e)
+                ret = False
+
+            if not ret:
+                if buf is not None:
+                    self._free_frames.put(buf)
+                failures += 1
+                self._backoff(failures)
+                continue
+
+            failures = 0
+            stale = self._latest_frame.put(frame)
+            if stale is not None:
+                self._free_frames.put(stale)
+
+    def detection_monitor(self):
+        """Detector loop, runs motion and plate checks on the freshest captured frame"""
+        print("Detection monitor started")
         COOLDOWN = 30
 
+        failures = 0
         while not self.shutdown_event.is_set():
             try:
-                ret, frame = self.camera.read()
-                if not ret:
-                    time.sleep(1)
+                frame = self._latest_frame.get(timeout=1.0)
+                if frame is None:
                     continue
 
-                self.show_preview(frame)
+                now = time.monotonic()
+                if now - self._last_detection_time > COOLDOWN:
+                    motion = self.detect_motion(frame)
+                    logger.debug("Motion: %s", motion)
+                    plate_idle = self._inflight_plate is None or self._inflight_plate.done()
+                    if motion is not None and plate_idle:
+                        # Only send the moving region (plus a margin) to Rekognition
+                        x, y, w, h = motion
+                        pad = 20
+                        roi = frame[max(0, y - pad):y + h + pad, max(0, x - pad):x + w + pad]
+
+                        # Copy the ROI, the frame buffer is recycled once the preview is done with it
+                        self._inflight_plate = self._plate_pool.submit(self.process_plate, roi.copy())
+                        self._inflight_plate.add_done_callback(self._on_plate_result)
+
+                # Hand off last, the preview draws its overlay onto the frame in place
+                if self.preview_enabled:
+                    with self._preview_lock:
+                        frame, self._preview_slot = self._preview_slot, frame
+                if frame is not None:
+                    self._free_frames.put(frame)
+                failures = 0
+            except (cv2.error, RuntimeError) as e:
+                # RuntimeError is the plate pool refusing work during shutdown
+                logger.warning("Detection error: %s", e)
+                failures += 1
+                self._backoff(failures)
+
+    def _backoff(self, failures, cap=1.0):
+        """Wait after consecutive failures, doubling from 20 ms up to cap seconds, wakes on shutdown"""
+        self.shutdown_event.wait(min(cap, 0.01 * 2 ** failures))
+
+    def _on_plate_result(self, future):
+        """Open the door when a background plate check comes back authorized"""
+        if future.result():
+            self._last_detection_time = time.monotonic()
+            self.open_door()
+
+    def show_preview(self):
+        """Display the newest camera frame, HighGUI calls must stay on the main thread"""
+        if not self.preview_enabled:
+            if self._preview_shown:
+                cv2.destroyWindow(self.preview_window_name)
+                cv2.pollKey()  # Let HighGUI process the close
+                self._preview_shown = False
+            return
 
-                current_time = time.time()
-                if current_time - last_detection_time > COOLDOWN:
-                    if self.detect_motion(frame):
-                        if self.process_plate(frame):
-                            self.open_door()
-                            last_detection_time = current_time
-            except:
-                pass
+        # Redraw at about 10 FPS, keys are still polled by run() in between
+        now = time.monotonic()
+        if now - self._last_preview_t < self.PREVIEW_INTERVAL:
+            return
+
+        with self._preview_lock:
+            frame = self._preview_slot
+            self._preview_slot = None
+
+        if frame is not None:
+            self._last_preview_t = now
+
+            # Show a downscaled frame, the overlay then lands on the small copy
+            display = frame
+            height, width = frame.shape[:2]
+            if width > self.PREVIEW_MAX_WIDTH:
+                # Keep the capture's aspect ratio, the negotiated resolution is not always 16:9
+                size = (self.PREVIEW_MAX_WIDTH, max(1, round(height * self.PREVIEW_MAX_WIDTH / width)))
+                if self._preview_buf is not None and self._preview_buf.shape[1::-1] != size:
+                    self._preview_buf = None
+                display = self._preview_buf = cv2.resize(frame, size, dst=self._preview_buf,
+                                                         interpolation=cv2.INTER_AREA)
+
+            if self._overlay is None:
+                self._overlay = self._render_overlay()
+            sprite, mask, (x, y) = self._overlay
+            region = display[y:y + sprite.shape[0], x:x + sprite.shape[1]]
+            if region.shape == sprite.shape:
+                np.copyto(region, sprite, where=mask)
+            cv2.imshow(self.preview_window_name, display)
+            self._preview_shown = True
+
+            # imshow keeps its own copy, the capture buffer can be reused
+            self._free_frames.put(frame)
+
+    def _render_overlay(self):
+        """Rasterize the preview hint text once into a small sprite and mask"""
+        text = "Press 'p' to hide"
+        (width, height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)
+        sprite = np.zeros((height + baseline + 4, width + 4, 3), np.uint8)
+        cv2.putText(sprite, text, (2, height + 2), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+        mask = sprite.any(axis=2, keepdims=True)
+
+        # Place the sprite so the text lands where it was drawn before, at (10, 30)
+        return sprite, mask, (8, 30 - height - 2)
+
+    def start_terminal_keys(self):
+        """Put the terminal in cbreak mode and start the key reader thread"""
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                read_key = msvcrt.getwch
+            else:
+                import termios
+                import tty
+                import atexit
+                fd = sys.stdin.fileno()
+                saved = termios.tcgetattr(fd)
+                tty.setcbreak(fd)  # Single keystrokes without Enter, Ctrl+C still interrupts
+                self._restore_terminal = lambda: termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+                atexit.register(self._restore_terminal)
+                read_key = lambda: sys.stdin.read(1)
+        except Exception as e:
+            print(f"Terminal keys unavailable: {e}")
+            return
+
+        threading.Thread(target=self.terminal_key_monitor, args=(read_key,), daemon=True).start()
 
-            time.sleep(0.1)
+    def terminal_key_monitor(self, read_key):
+        """Dispatch 'p' and 'q' typed in the terminal, sleeping in the blocking read between keys"""
+        while not self.shutdown_event.is_set():
+            try:
+                key = read_key().lower()
+            except (OSError, ValueError):
+                return
 
-    def show_preview(self, frame):
-        if self.preview_enabled and frame is not None:
-            preview_frame = frame.copy()
-            cv2.putText(preview_frame, "Press 'p' to hide",
-                        (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-            cv2.imshow(self.preview_window_name, preview_frame)
-            cv2.waitKey(1)
+            if not key:
+                return  # stdin closed
+            if key == 'p':
+                self.toggle_preview()
+            elif key == 'q':
+                # shutdown() closes HighGUI windows, leave it to the main thread
+                self._quit.set()
+                self._wake.set()
+                return
 
     def toggle_preview(self):
         self.preview_enabled = not self.preview_enabled
-        if not self.preview_enabled:
-            cv2.destroyWindow(self.preview_window_name)
+        self._wake.set()
+
+    def run(self):
+        """Main thread loop, polls the preview keys at about 30 Hz and redraws the preview at about 10 FPS"""
+        while not self.shutdown_event.is_set():
+            if self._quit.is_set():
+                self.shutdown()
+
+            self.show_preview()
+            if not self._preview_shown:
+                # No window to pump, wait for a preview toggle instead of polling
+                self._wake.wait(1.0)
+                self._wake.clear()
+                continue
+
+            key = cv2.pollKey() & 0xFF
+            if key == ord('p'):
+                self.toggle_preview()
+            elif key == ord('q'):
+                self.shutdown()
+            time.sleep(1 / 30)
 
     def voice_monitor(self):
         if not self.voice_available:
             return
 
+        if self.voice_offline:
+            self.offline_voice_monitor()
+            return
+
         print("Voice monitor started")
 
         with self.microphone as source:
             self.recognizer.adjust_for_ambient_noise(source)
 
+        failures = 0
         while not self.shutdown_event.is_set():
             try:
                 with self.microphone as source:
                     audio = self.recognizer.listen(source, timeout=5)
-                text = self.recognizer.recognize_google(audio).lower()
-
-                if "open" in text and "garage" in text and not self.door_open:
-                    self.open_door()
-                elif "close" in text and "garage" in text and self.door_open:
-                    self.close_door()
-            except:
-                pass
+                self._handle_voice(self.recognizer.recognize_google(audio))
+                failures = 0
+            except (sr.WaitTimeoutError, sr.UnknownValueError):
+                failures = 0  # Silence or unintelligible speech, keep listening
+            except (sr.RequestError, OSError) as e:
+                # Recognition service or microphone trouble, back off up to 30 seconds
+                logger.warning("Voice recognition error: %s", e)
+                failures += 1
+                self._backoff(failures, cap=30.0)
 
             time.sleep(1)
 
-    def check_keyboard_input(self):
+    def offline_voice_monitor(self):
+        """Buffer speech frames flagged by the VAD and recognize each utterance locally"""
+        print("Voice monitor started (offline)")
+
+        frame_samples = self.VOICE_RATE * self.VOICE_FRAME_MS // 1000
+        silence_frames = self.VOICE_SILENCE_MS // self.VOICE_FRAME_MS
+        max_frames = self.VOICE_MAX_MS // self.VOICE_FRAME_MS
+
+        # Restrict decoding to the command vocabulary, anything else comes back as [unk]
+        vocabulary = sorted(self._OPEN_KEYS | self._CLOSE_KEYS | self._GARAGE | {'the'}) + ['[unk]']
+        recognizer = vosk.KaldiRecognizer(self._vosk_model, self.VOICE_RATE, json.dumps(vocabulary))
+
+        speech = bytearray()
+        failures = 0
         while not self.shutdown_event.is_set():
+            stream = None
             try:
-                if sys.platform == "win32":
-                    import msvcrt
-                    if msvcrt.kbhit():
-                        key = msvcrt.getch().decode().lower()
-                        if key == 'p':
-                            self.toggle_preview()
-                        elif key == 'q':
-                            self.shutdown()
-                else:
-                    import select
-                    if select.select([sys.stdin], [], [], 0)[0]:
-                        key = sys.stdin.readline().strip().lower()
-                        if key == 'p':
-                            self.toggle_preview()
-                        elif key == 'q':
-                            self.shutdown()
-            except:
-                pass
-            time.sleep(0.1)
+                stream = self._audio.open(format=pyaudio.paInt16, channels=1, rate=self.VOICE_RATE,
+                                          input=True, frames_per_buffer=frame_samples)
+                speech.clear()
+                frames = silent = 0
+                while not self.shutdown_event.is_set():
+                    chunk = stream.read(frame_samples, exception_on_overflow=False)
+                    failures = 0
+                    if self._vad.is_speech(chunk, self.VOICE_RATE):
+                        silent = 0
+                    elif speech:
+                        silent += 1
+                    else:
+                        continue  # Nothing to do until someone speaks
+
+                    speech += chunk
+                    frames += 1
+                    if silent < silence_frames and frames < max_frames:
+                        continue
+
+                    recognizer.AcceptWaveform(bytes(speech))
+                    text = json_loads(recognizer.FinalResult()).get('text', '')
+                    speech.clear()
+                    frames = silent = 0
+                    if text:
+                        self._handle_voice(text)
+            except OSError as e:
+                # Microphone trouble, back off up to 30 seconds and reopen the stream
+                logger.warning("Voice capture error: %s", e)
+                failures += 1
+                self._backoff(failures, cap=30.0)
+            finally:
+                if stream is not None:
+                    try:
+                        stream.stop_stream()
+                        stream.close()
+                    except OSError:
+                        pass
+
+    def _handle_voice(self, text):
+        """Open or close the door when recognized text matches the command grammar"""
+        words = frozenset(text.lower().split())
+        if self._OPEN_KEYS <= words and not self.door_open:
+            self.open_door()
+        elif words & self._CLOSE_KEYS and words & self._GARAGE and self.door_open:
+            self.close_door()
 
     def shutdown(self):
         print("Shutting down system...")
         self.shutdown_event.set()
+        self._wake.set()
 
         if self.simulator_process:
             try:
@@ -407,16 +1156,27 @@ class GarageSystem:
             except:
                 pass
 
-        if self.auto_close_timer:
-            self.auto_close_timer.cancel()
+        self._close_evt.set()
+
+        self._cmd_pool.shutdown(wait=False)
+        self._plate_pool.shutdown(wait=False)
+        self.stop_motion_process()
 
         if self.camera_available:
             self.camera.release()
 
         cv2.destroyAllWindows()
 
+        # os._exit skips atexit, put the terminal back explicitly
+        if self._restore_terminal is not None:
+            try:
+                self._restore_terminal()
+            except Exception:
+                pass
+
         try:
             self.mqtt_client.disconnect()
+            self.mqtt_client.loop_stop()
         except:
             pass
 
@@ -424,9 +1184,9 @@ class GarageSystem:
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     system = GarageSystem()
     try:
-        while not system.shutdown_event.is_set():
-            time.sleep(1)
+        system.run()
     except KeyboardInterrupt:
         system.shutdown()
\ No newline at end of file